@@ -1,4 +1,5 @@
 from collections import deque
+from itertools import islice
 from typing import Any, Deque, Dict, List
 import time
 
@@ -15,7 +16,10 @@ class RingLog:
     def latest(self, limit: int = 50) -> List[Dict[str, Any]]:
         if limit <= 0:
             return []
-        return list(self._dq)[-limit:]
+        # islice på deque stegar från vänster; reversed() ger O(limit)
+        items = list(islice(reversed(self._dq), limit))
+        items.reverse()
+        return items
 
     def __len__(self) -> int:
         return len(self._dq)
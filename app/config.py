@@ -1,3 +1,5 @@
+from functools import cached_property
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import List
 import os
@@ -15,6 +17,7 @@ class Settings(BaseSettings):
 
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
 
+    @cached_property
     def parsed_origins(self) -> List[str]:
         if not self.ALLOWED_ORIGINS:
             return [
@@ -1,8 +1,9 @@
 import asyncio
-import json
 import logging
 from typing import Optional
 
+import msgpack
+import orjson
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -18,7 +19,7 @@ app = FastAPI(title="stefan-api-test-6 Realtime STT")
 # --- CORS (tillåt *.lovable.app + listade origins)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=settings.parsed_origins(),
+    allow_origins=settings.parsed_origins,
     allow_origin_regex=r"https://.*\.lovable\.app$",
     allow_credentials=True,
     allow_methods=["*"],
@@ -28,10 +29,18 @@ app.add_middleware(
 # Ringbuffers
 ring_size = settings.RING_SIZE
 front_chunks = RingLog(ring_size)   # chunkar mottagna från FE
-openai_chunks = RingLog(ring_size)  # chunkar skickade (samma i detta fall)
+openai_chunks = RingLog(ring_size)  # append:ar skickade (kan vara sammanslagna)
 openai_text = RingLog(ring_size)    # text från OpenAI
 front_text = RingLog(ring_size)     # text skickad till FE
 
+# Max antal textmeddelanden per WebSocket-frame till FE, och hur många som får köas
+FE_BATCH_MAX = 64
+FE_QUEUE_MAX = 1024
+
+# Max antal FE-chunkar per append till OpenAI, och hur många som får köas
+AUDIO_BATCH_MAX = 32
+AUDIO_QUEUE_MAX = 256
+
 @app.get("/healthz")
 def healthz():
     return {"status": "ok"}
@@ -42,7 +51,7 @@ def config():
         "model": settings.OPENAI_REALTIME_MODEL,
         "language": settings.LANGUAGE,
         "sample_rate": settings.SAMPLE_RATE,
-        "allowed_origins": settings.parsed_origins(),
+        "allowed_origins": settings.parsed_origins,
         "allow_origin_regex": r"https://.*\.lovable\.app$",
     }
 
@@ -68,6 +77,17 @@ def debug_front_text(limit: int = Query(50, ge=1, le=1000)):
 async def ws_endpoint(ws: WebSocket):
     await ws.accept()
     session: Optional[OpenAIRealtimeSession] = None
+    # JSON i textframes, ett meddelande per frame som default. FE kan slå på
+    # msgpack och/eller batch-frames med {"type": "hello", "codec": "msgpack", "batch": true}
+    codec = "json"
+    batch_frames = False
+
+    async def send_message(obj):
+        if codec == "msgpack":
+            await ws.send_bytes(msgpack.packb(obj, use_bin_type=True))
+        else:
+            await ws.send_text(orjson.dumps(obj).decode())
+
     try:
         # Skapa Realtime-session per klient
         session = OpenAIRealtimeSession(
@@ -78,30 +98,75 @@ async def ws_endpoint(ws: WebSocket):
         )
         await session.__aenter__()
 
-        async def pump_client_to_openai():
+        async def read_client():
             while True:
                 msg = await ws.receive()
                 # Både text och bytes kan förekomma. Vi förväntar oss binära PCM16.
-                if "bytes" in msg and msg["bytes"] is not None:
-                    raw = msg["bytes"]
-                    t0 = now_s()
-                    start_s, end_s = await session.send_audio_chunk(raw)
-                    front_chunks.add({"t": t0, "bytes": len(raw), "start_s": start_s, "end_s": end_s})
-                    openai_chunks.add({"t": t0, "bytes": len(raw), "start_s": start_s, "end_s": end_s})
-                elif "text" in msg and msg["text"] is not None:
-                    # valfritt kontrollmeddelande från FE
+                raw = msg.get("bytes")
+                if raw is not None:
+                    # Stämpla vid ankomst; front_chunks ska visa när FE-framen kom
+                    await in_q.put((now_s(), raw))
+                    continue
+                text = msg.get("text")
+                if text is not None:
+                    await in_q.put(text)
+
+        async def handle_control(text: str):
+            nonlocal codec, batch_frames
+            # valfritt kontrollmeddelande från FE
+            try:
+                data = orjson.loads(text)
+                cmd = data.get("type")
+                if cmd == "hello":
+                    if data.get("codec") in ("json", "msgpack"):
+                        codec = data["codec"]
+                    if isinstance(data.get("batch"), bool):
+                        batch_frames = data["batch"]
+                elif cmd == "flush":
+                    # endast relevant om server_vad är avstängt
+                    # await session.commit()
+                    pass
+                elif cmd == "reset":
+                    await session.clear()
+                # Ignorera övrigt
+            except Exception:
+                pass
+
+        async def pump_client_to_openai():
+            # Chunkar som hunnit köas medan förra append skickades slås ihop
+            # till en append. Kontrollmeddelanden bryter batchen så att
+            # ordningen mot ljudet bevaras.
+            pending: Optional[str] = None
+            while True:
+                if pending is not None:
+                    item, pending = pending, None
+                else:
+                    item = await in_q.get()
+                if isinstance(item, str):
+                    await handle_control(item)
+                    continue
+
+                chunks = [item]
+                while len(chunks) < AUDIO_BATCH_MAX:
                     try:
-                        data = json.loads(msg["text"])
-                        cmd = data.get("type")
-                        if cmd == "flush":
-                            # endast relevant om server_vad är avstängt
-                            # await session.commit()
-                            pass
-                        elif cmd == "reset":
-                            await session.clear()
-                        # Ignorera övrigt
-                    except Exception:
-                        pass
+                        item = in_q.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    if isinstance(item, str):
+                        pending = item
+                        break
+                    chunks.append(item)
+
+                t0 = now_s()
+                spans = await session.send_audio_batch([raw for _, raw in chunks])
+                for (t, raw), (start_s, end_s) in zip(chunks, spans):
+                    front_chunks.add({"t": t, "bytes": len(raw), "start_s": start_s, "end_s": end_s})
+                openai_chunks.add({
+                    "t": t0,
+                    "bytes": sum(len(raw) for _, raw in chunks),
+                    "start_s": spans[0][0],
+                    "end_s": spans[-1][1],
+                })
 
         async def pump_openai_to_client():
             async for evt in session.events():
@@ -109,24 +174,57 @@ async def ws_endpoint(ws: WebSocket):
                     continue
 
                 payload = {
-                    "type": "partial" if evt["partial"] and not evt["final"] else "final" if evt["final"] else "partial",
+                    "type": evt["type"],
                     "text": evt["text"],
                     "ts": {"start_s": evt.get("start_s"), "end_s": evt.get("end_s")},
                     "event": evt.get("event_type"),
                 }
-                # Logga inkommande och utgående text
-                openai_text.add({"t": now_s(), **payload})
-                await ws.send_text(json.dumps(payload))
-                front_text.add({"t": now_s(), **payload})
-
-        await asyncio.gather(pump_client_to_openai(), pump_openai_to_client())
+                # Logga inkommande text; writern lägger samma post i front_text
+                # (RingLog sparar bara referensen och ingen muterar posten)
+                entry = {"t": now_s(), **payload}
+                openai_text.add(entry)
+                await out_q.put((entry, payload))
+
+        async def write_to_client():
+            # Töm allt som redan ligger i kön. Med batch-frames påslaget går det
+            # som en frame; långsam ström => ett meddelande per frame, skurar => batchas.
+            while True:
+                batch = [await out_q.get()]
+                while len(batch) < FE_BATCH_MAX:
+                    try:
+                        batch.append(out_q.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+
+                items = [payload for _, payload in batch]
+                if batch_frames and len(items) > 1:
+                    await send_message({"type": "batch", "items": items})
+                else:
+                    for payload in items:
+                        await send_message(payload)
+                for entry, _ in batch:
+                    front_text.add(entry)
+
+        in_q: asyncio.Queue = asyncio.Queue(maxsize=AUDIO_QUEUE_MAX)
+        out_q: asyncio.Queue = asyncio.Queue(maxsize=FE_QUEUE_MAX)
+        # gather avbryter inte övriga pumpar när en faller; writern väntar
+        # annars för evigt på kön efter disconnect.
+        tasks = [
+            asyncio.ensure_future(c)
+            for c in (read_client(), pump_client_to_openai(), pump_openai_to_client(), write_to_client())
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
 
     except WebSocketDisconnect:
         log.info("WebSocket disconnected")
     except Exception as e:
         log.exception("WebSocket error: %s", e)
         try:
-            await ws.send_text(json.dumps({"type": "error", "error": str(e)}))
+            await send_message({"type": "error", "error": str(e)})
         except Exception:
             pass
     finally:
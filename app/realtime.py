@@ -1,32 +1,58 @@
 import asyncio
 import base64
-import json
 import logging
-from typing import Any, AsyncGenerator, Dict, Optional, Tuple
+import socket
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
 
+import orjson
 import websockets
 
 log = logging.getLogger("realtime")
 
 
-def b64_audio_pcm16(raw: bytes) -> str:
-    return base64.b64encode(raw).decode("ascii")
+# input_audio_buffer.append har fast form; bara base64-datat varierar.
+# base64 behöver ingen JSON-escaping, så framen kan byggas med konkatenering.
+_AUDIO_PREFIX = b'{"type":"input_audio_buffer.append","audio":"'
+_AUDIO_SUFFIX = b'"}'
 
 
-def safe_get(d: Dict[str, Any], path: str, default=None):
-    cur = d
-    for k in path.split("."):
-        if not isinstance(cur, dict) or k not in cur:
-            return default
-        cur = cur[k]
-    return cur
+_PARTIAL_SUFFIXES = (".delta", ".partial")
+_FINAL_SUFFIXES = (".done", ".completed", ".final")
+_EVT_TYPE_CACHE: Dict[str, Tuple[bool, bool]] = {}
+
+
+def classify_event_type(evt_type: str) -> Tuple[bool, bool]:
+    '''Returnerar (is_partial, is_final) för en eventtyp, cachat per typ.'''
+    cached = _EVT_TYPE_CACHE.get(evt_type)
+    if cached is None:
+        cached = (evt_type.endswith(_PARTIAL_SUFFIXES), evt_type.endswith(_FINAL_SUFFIXES))
+        _EVT_TYPE_CACHE[evt_type] = cached
+    return cached
+
+
+# Läsa textfält: text / text_delta / transcript / transcript_delta
+_TEXT_KEYS = ("text", "text_delta", "transcript", "transcript_delta")
+
+
+def extract_text(d: Dict[str, Any]) -> Optional[str]:
+    for k in _TEXT_KEYS:
+        v = d.get(k)
+        if isinstance(v, str) and v:
+            return v
+    # ibland kapslat
+    v = (
+        d.get("audio") or {}
+    ).get("transcript") or d.get("transcription") or (d.get("response") or {}).get("output_text")
+    if isinstance(v, str) and v:
+        return v
+    return None
 
 
 class OpenAIRealtimeSession:
     '''
     Minimal wrapper runt Realtime WebSocket (server-to-server).
     - Skickar input_audio_buffer.append med base64-enkoderad PCM16
-    - Lyssnar på transkriptionshändelser och yield:ar {type, text, start_s, end_s, raw}
+    - Lyssnar på transkriptionshändelser och yield:ar {type, text, start_s, end_s}
     '''
     def __init__(
         self,
@@ -58,7 +84,24 @@ class OpenAIRealtimeSession:
             "Authorization": f"Bearer {self.api_key}",
             "OpenAI-Beta": "realtime=v1",
         }
-        self._ws = await websockets.connect(url, extra_headers=headers, max_size=16 * 1024 * 1024)
+        # Större kö/buffertar än default (max_queue=16) så att skurar av
+        # delta-event inte stoppar läsningen; 512 ger fortfarande ett tak
+        # om FE-sidan är långsam.
+        self._ws = await websockets.connect(
+            url,
+            extra_headers=headers,
+            max_size=16 * 1024 * 1024,
+            max_queue=512,
+            read_limit=2**20,
+            write_limit=2**20,
+        )
+        # Små append-frames ska inte vänta på Nagle
+        sock = self._ws.transport.get_extra_info("socket")
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                log.warning("Could not set TCP_NODELAY on Realtime socket")
 
         # Konfigurera sessionen: PCM16 + svenska + server-VAD + transcribe-only
         session_update = {
@@ -83,24 +126,39 @@ class OpenAIRealtimeSession:
 
     async def _send_json(self, obj: Dict[str, Any]) -> None:
         assert self._ws is not None
-        payload = json.dumps(obj)
+        # Realtime förväntar sig textframes, därav decode()
+        payload = orjson.dumps(obj).decode()
         await self._ws.send(payload)
 
-    async def send_audio_chunk(self, raw_pcm16: bytes) -> Tuple[float, float]:
-        '''
-        Skickar en audio-chunk. Returnerar (start_s, end_s) approx utifrån chunk-längd/samplerate.
-        '''
-        assert self._ws is not None
-        n_samples = len(raw_pcm16) / 2.0  # 16-bit
+    def _advance_clock(self, n_bytes: int) -> Tuple[float, float]:
+        n_samples = n_bytes / 2.0  # 16-bit
         dur_s = n_samples / float(self.sample_rate)
         start_s = self._audio_time_s
         end_s = start_s + dur_s
         self._audio_time_s = end_s
-
-        evt = {"type": "input_audio_buffer.append", "audio": b64_audio_pcm16(raw_pcm16)}
-        await self._send_json(evt)
         return start_s, end_s
 
+    async def _send_audio(self, raw_pcm16: bytes) -> None:
+        assert self._ws is not None
+        # Textframe (Realtime kräver det): en decode för hela framen
+        frame = _AUDIO_PREFIX + base64.b64encode(raw_pcm16) + _AUDIO_SUFFIX
+        await self._ws.send(frame.decode("ascii"))
+
+    async def send_audio_chunk(self, raw_pcm16: bytes) -> Tuple[float, float]:
+        '''
+        Skickar en audio-chunk. Returnerar (start_s, end_s) approx utifrån chunk-längd/samplerate.
+        '''
+        return (await self.send_audio_batch([raw_pcm16]))[0]
+
+    async def send_audio_batch(self, chunks: List[bytes]) -> List[Tuple[float, float]]:
+        '''
+        Skickar flera chunkar som en enda input_audio_buffer.append.
+        Returnerar (start_s, end_s) per chunk, i samma ordning.
+        '''
+        spans = [self._advance_clock(len(raw)) for raw in chunks]
+        await self._send_audio(b"".join(chunks))
+        return spans
+
     async def commit(self) -> None:
         '''Om du vill committa manuellt (ej nödvändigt med server_vad).'''
         await self._send_json({"type": "input_audio_buffer.commit"})
@@ -122,7 +180,7 @@ class OpenAIRealtimeSession:
                 break
 
             try:
-                data = json.loads(msg)
+                data = orjson.loads(msg)
             except Exception:
                 log.warning("Non-JSON message from Realtime: %s", msg[:200])
                 continue
@@ -133,35 +191,21 @@ class OpenAIRealtimeSession:
             # - conversation.item.input_audio_transcription.delta / .completed / .done
             # - response.audio_transcript.delta / .done
             # - response.text.delta (fallback)
-            # Läsa textfält: text / text_delta / transcript / transcript_delta
-            def extract_text(d: Dict[str, Any]) -> Optional[str]:
-                for k in ("text", "text_delta", "transcript", "transcript_delta"):
-                    v = d.get(k)
-                    if isinstance(v, str) and v:
-                        return v
-                # ibland kapslat
-                v = (
-                    d.get("audio") or {}
-                ).get("transcript") or d.get("transcription") or safe_get(d, "response.output_text")
-                if isinstance(v, str) and v:
-                    return v
-                return None
-
-            is_partial = any(s in evt_type for s in (".delta", ".partial"))
-            is_final = any(s in evt_type for s in (".done", ".completed", ".final"))
+            is_partial, is_final = classify_event_type(evt_type)
 
             text = extract_text(data) or ""
 
             # timestamps: vissa event har metadata; annars använd approx-klocka
-            start_s = safe_get(data, "audio.start_time_s", None)
-            end_s = safe_get(data, "audio.end_time_s", None)
+            audio = data.get("audio") or {}
+            start_s = audio.get("start_time_s")
+            end_s = audio.get("end_time_s")
 
             yield {
                 "event_type": evt_type,
+                "type": "final" if is_final else "partial",
                 "partial": is_partial and not is_final,
                 "final": is_final,
                 "text": text,
                 "start_s": start_s,
                 "end_s": end_s,
-                "raw": data,
             }